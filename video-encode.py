@@ -12,25 +12,46 @@
 # constant quality produces a higher quality output compared to average bitrate, even if the
 # resulting file size is the same.
 #
-# dependencies: handbrakecli, ffprobe, ffmpeg, dovi_tool, mkvmerge, mkvpropedit, mkvextract
+# dependencies: handbrakecli, ffprobe, ffmpeg, dovi_tool, mkvmerge, mkvpropedit
 
 import argparse
+import copy
 import subprocess
 import os
+import platform
 import json
 from dataclasses import dataclass
 import tempfile
 import logging
-from fractions import Fraction
+import functools
+import atexit
+import shutil
+import hashlib
+import sys
+import fcntl
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
-@dataclass
-class Subtitle:
-    index: int
-    language: str
-    forced: bool
-    type: str
+CACHE_DIRECTORY = os.path.expanduser('~/.cache/video-encode')
+FFPROBE_CACHE_PATH = os.path.join(CACHE_DIRECTORY, 'ffprobe.json')
+CQ_CACHE_PATH = os.path.join(CACHE_DIRECTORY, 'cq_cache.json')
+FINGERPRINT_CHUNK_SIZE = 1 << 22
+PIPE_BUFFER_SIZE = 1 << 20
+SAMPLE_DURATION_IN_SECONDS = 10
+REQUIRED_TOOLS = ['ffprobe', 'handbrakecli', 'ffmpeg', 'dovi_tool', 'mkvmerge', 'mkvpropedit']
+FFPROBE_ARGUMENTS = ['-loglevel', 'quiet',
+                     '-show_entries', 'stream=codec_type,codec_name,height,avg_frame_rate,channels'
+                                      ':stream_side_data=side_data_type'
+                                      ':stream_tags=language'
+                                      ':stream_disposition=forced'
+                                      ':format=bit_rate,duration',
+                     '-print_format', 'json=compact=1']
+# part of every ffprobe cache key, so output cached with other arguments is never reused
+FFPROBE_ARGUMENTS_KEY = hashlib.sha256(' '.join(FFPROBE_ARGUMENTS).encode()).hexdigest()[:16]
+
+devnull = open(os.devnull, 'wb')
 
 @dataclass
 class Audio:
@@ -39,62 +60,118 @@ class Audio:
     channels: int
 
 
+def load_json_cache(cache_path):
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_json_cache(cache_path, cache):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+
+
+ffprobe_cache = load_json_cache(FFPROBE_CACHE_PATH)
+
+
+def save_ffprobe_cache():
+    # forget files that are gone and entries probed with other arguments
+    for key in list(ffprobe_cache):
+        key_parts = key.rsplit(':', 3)
+        if key_parts[-1] != FFPROBE_ARGUMENTS_KEY or not os.path.isfile(key_parts[0]):
+            del ffprobe_cache[key]
+    save_json_cache(FFPROBE_CACHE_PATH, ffprobe_cache)
+
+
+atexit.register(save_ffprobe_cache)
+
+
+@functools.lru_cache(maxsize=256)
+def probe_file(file_path, size, modified_time):
+    key = f'{file_path}:{size}:{modified_time}:{FFPROBE_ARGUMENTS_KEY}'
+    if key not in ffprobe_cache:
+        ffprobe = subprocess.Popen([tool_path('ffprobe'), *FFPROBE_ARGUMENTS, file_path],
+                                   stdout=subprocess.PIPE, stderr=devnull, close_fds=False)
+        with ffprobe.stdout:
+            media_info = json.load(ffprobe.stdout)
+        # don't let a file ffprobe couldn't read stay broken on later runs
+        if ffprobe.wait() != 0:
+            return media_info
+        ffprobe_cache[key] = media_info
+    return ffprobe_cache[key]
+
+
 class FFProbe:
     def __init__(self, input_file_path):
         self.file_path = input_file_path
         if os.path.isfile(self.file_path) == False:
             raise IOError(f'file does not exist: {self.file_path}')
-        
-        output = subprocess.run([
-            'ffprobe',
-            '-loglevel', 'quiet',
-            '-show_streams',
-            '-show_format', 
-            '-print_format', 'json',
-            self.file_path
-        ], capture_output=True, text=True)
 
-        media_info = json.loads(output.stdout)
+        file_stat = os.stat(self.file_path)
+        media_info = probe_file(os.path.abspath(self.file_path), file_stat.st_size, file_stat.st_mtime_ns)
 
         self.height = 0
         self.duration_in_seconds = 0
         self.bitrate = 0
         self.frame_rate = 0
         self.is_dolby_vision = False
-        self.subtitles = []
         self.audios = []
 
-        audio_index = 0
-        subtitle_index = 0
-        for stream in media_info.get('streams'):
-            if stream.get('codec_type') == 'video':
-                self.height = int(stream.get('height'))
-                self.frame_rate = stream.get('avg_frame_rate')
-                if stream.get('side_data_list'):
-                    self.is_dolby_vision = stream.get('side_data_list')[0].get('side_data_type') == 'DOVI configuration record'
-            elif stream.get('codec_type') == 'audio':
-                audio_index += 1
-                audio = Audio(
-                    index=audio_index,
-                    language=stream.get('tags').get('language'),
-                    channels=stream.get('channels')
-                )
-                self.audios.append(audio)
-            elif stream.get('codec_type') == 'subtitle':
-                subtitle_index += 1
-                subtitle = Subtitle(
-                    index=subtitle_index,
-                    language=stream.get('tags').get('language'),
-                    forced=stream.get('disposition').get('forced') == 1,
-                    type=stream.get('codec_name')
-                )
-                self.subtitles.append(subtitle)
-
-        self.bitrate = float(media_info.get('format').get('bit_rate'))
-        self.duration_in_seconds = float(media_info.get('format').get('duration'))
+        streams_by_type = {'video': [], 'audio': [], 'subtitle': []}
+        for stream in media_info.get('streams') or []:
+            codec_type = stream.get('codec_type')
+            if codec_type in streams_by_type:
+                streams_by_type[codec_type].append(stream)
+
+        if streams_by_type['video']:
+            video_stream = streams_by_type['video'][0]
+            self.height = int(video_stream.get('height'))
+            self.frame_rate = video_stream.get('avg_frame_rate')
+            side_data_list = video_stream.get('side_data_list')
+            if side_data_list:
+                self.is_dolby_vision = side_data_list[0].get('side_data_type') == 'DOVI configuration record'
+
+        # handbrake numbers audio and subtitle tracks from 1 within their own type.
+        # streams without metadata leave tags and disposition out entirely
+        for audio_index, stream in enumerate(streams_by_type['audio'], start=1):
+            tags = stream.get('tags') or {}
+            audio = Audio(
+                index=audio_index,
+                language=tags.get('language'),
+                channels=stream.get('channels')
+            )
+            self.audios.append(audio)
+
+        subtitle_streams = streams_by_type['subtitle']
+        self.subtitle_indexes = tuple(range(1, len(subtitle_streams) + 1))
+        self.subtitle_languages = tuple((stream.get('tags') or {}).get('language') for stream in subtitle_streams)
+        self.subtitle_forced = tuple((stream.get('disposition') or {}).get('forced') == 1 for stream in subtitle_streams)
+        self.subtitle_types = tuple(stream.get('codec_name') for stream in subtitle_streams)
+
+        format_info = media_info.get('format')
+        if format_info is None:
+            raise IOError(f'ffprobe could not read file: {self.file_path}')
+        self.bitrate = float(format_info.get('bit_rate'))
+        self.duration_in_seconds = float(format_info.get('duration'))
+
+
+@functools.lru_cache(maxsize=None)
+def tool_path(tool_name):
+    # subprocess only takes the cheaper posix_spawn path for executables given with a directory
+    return shutil.which(tool_name) or tool_name
 
 
 class Handbrake:
+    ENCODER_COMMAND = ('--encoder', 'vt_h265_10bit',
+                       '--encoder-preset', 'quality',
+                       '--encoder-profile', 'auto',
+                       '--encoder-level', 'auto')
+    MARKERS_COMMAND = ('--markers',)
+    NO_DEINTERLACE_COMMAND = ('--no-comb-detect', '--no-decomb')
+
     def __init__(self):
         self.input_file = ''
         self.input_command = []
@@ -105,10 +182,6 @@ class Handbrake:
         self.burn_subtitle_command = []
         self.start_at_command = []
         self.stop_at_command = []
-        self.encoder_command = ['--encoder', 'vt_h265_10bit',
-                                '--encoder-preset', 'quality',
-                                '--encoder-profile', 'auto',
-                                '--encoder-level', 'auto']
         self.audio_encoder_command = []
 
     def input(self, input_file_path):
@@ -161,96 +234,43 @@ class Handbrake:
         elif not self.audio_encoder_command:
             raise TypeError('handbrakecli missing audio options')
 
-        command = ['handbrakecli']
-        command += self.input_command
-        command += self.output_command
-        command += self.start_at_command
-        command += self.stop_at_command
-        command += self.previews_command
-        command += self.crop_command
-        command += ['--markers']
-        command += self.encoder_command
-        command += ['--no-comb-detect', '--no-decomb']
-        command += self.quality_command
-        command += self.audio_encoder_command
-        command += self.burn_subtitle_command
+        command = [tool_path('handbrakecli'),
+                   *self.input_command,
+                   *self.output_command,
+                   *self.start_at_command,
+                   *self.stop_at_command,
+                   *self.previews_command,
+                   *self.crop_command,
+                   *self.MARKERS_COMMAND,
+                   *self.ENCODER_COMMAND,
+                   *self.NO_DEINTERLACE_COMMAND,
+                   *self.quality_command,
+                   *self.audio_encoder_command,
+                   *self.burn_subtitle_command]
 
         if quiet_run:
-            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            subprocess.run(command, stdout=devnull, stderr=devnull, close_fds=False)
         else:
             logger.info(f'Encoding command for file: {os.path.basename(self.input_file)}:')
             logger.info(' '.join(command))
-            subprocess.run(command)
+            subprocess.run(command, close_fds=False)
 
 
-def verify_ffprobe():
-    print('Verifying ffprobe...')
-    try:
-        subprocess.check_call(['ffprobe', '-version'], 
-                              stdout=subprocess.DEVNULL, 
-                              stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise IOError('ffprobe not found')
-    
+def verify_tools():
+    missing_tools = []
+    for tool_name in REQUIRED_TOOLS:
+        print(f'Verifying {tool_name}...')
+        if shutil.which(tool_name) is None:
+            missing_tools.append(tool_name)
+    if missing_tools:
+        raise IOError(f'{", ".join(missing_tools)} not found')
 
-def verify_handbrakecli():
-    print('Verifying handbrakecli...')
-    try:
-        subprocess.check_call(['handbrakecli', '--version'],
-                              stdout=subprocess.DEVNULL,
-                              stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise IOError('handbrakecli not found')
-    
-
-def verify_ffmpeg():
-    print('Verifying ffmpeg...')
-    try:
-        subprocess.check_call(['ffmpeg', '-version'],
-                              stdout=subprocess.DEVNULL,
-                              stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise IOError('ffmpeg not found')
-    
-
-def verify_dovi_tool():
-    print('Verifying dovi_tool...')
-    try:
-        subprocess.check_call(['dovi_tool', '--version'],
-                              stdout=subprocess.DEVNULL,
-                              stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise IOError('dovi_tool not found')
-    
-
-def verify_mkvmerge():
-    print('Verifying mkvmerge...')
-    try:
-        subprocess.check_call(['mkvmerge', '--version'],
-                              stdout=subprocess.DEVNULL,
-                              stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise IOError('mkvmerge not found')
-    
 
-def verify_mkvextract():
-    print('Verifying mkvextract...')
-    try:
-        subprocess.check_call(['mkvextract', '--version'],
-                              stdout=subprocess.DEVNULL,
-                              stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise IOError('mkvextract not found')
-    
-
-def verify_mkvpropedit():
-    print('Verifying mkvpropedit...')
-    try:
-        subprocess.check_call(['mkvpropedit', '--version'],
-                              stdout=subprocess.DEVNULL,
-                              stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise IOError('mkvpropedit not found')
+def default_concurrency():
+    # apple silicon has a small fixed pool of videotoolbox engines, further encodes only queue behind them
+    if sys.platform == 'darwin' and platform.machine() == 'arm64':
+        return 2
+    return max((os.cpu_count() or 1) // 2, 1)
 
 
 def parse_arguments():
@@ -266,7 +286,7 @@ def parse_arguments():
                         type=int,
                         metavar='BITRATE',
                         default=0,
-                        help='choose a bitrate to target (DEFAULT: 1080p=4000, 2160p=12000)')
+                        help='choose a bitrate to target (DEFAULT: 1080p=3000, 2160p=13000)')
     parser.add_argument('--quality',
                         type=int,
                         choices=range(1,101),
@@ -279,6 +299,11 @@ def parse_arguments():
     parser.add_argument('--crop',
                         action='store_true',
                         help='choose to auto crop (DEFAULT: no crop)')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        metavar='JOBS',
+                        default=0,
+                        help='number of sample encodes to run at once while finding cq (DEFAULT: 2 on apple silicon, otherwise half the cpus)')
     
     arguments = parser.parse_args()
 
@@ -287,183 +312,329 @@ def parse_arguments():
             arguments.burn_subtitle.isdigit() == False:
         raise argparse.ArgumentTypeError('Invalid option. Please choose \'none\', \'auto\', or a track number')
 
+    if arguments.concurrency < 0:
+        raise argparse.ArgumentTypeError('Invalid option. Please choose a number of jobs of 0 or more')
+
     return arguments
 
 
-def find_quality_option(media_info, target_bit_rate):
+def sample_bit_rate_kbps(sample_file_path, duration_in_seconds):
+    if os.path.isfile(sample_file_path) == False or os.path.getsize(sample_file_path) == 0:
+        raise IOError(f'sample encode failed: {sample_file_path}')
+    return os.path.getsize(sample_file_path) * 8 / duration_in_seconds / 1000
+
+
+def cut_samples(file_path, start_times, sample_directory, executor):
+    source_sample_file_names = []
+    commands = []
+    for sample_index, start_time_in_seconds in enumerate(start_times, start=1):
+        source_sample_file_name = os.path.join(sample_directory, f'source_sample_{sample_index}.mkv')
+        commands.append([
+            tool_path('ffmpeg'),
+            '-nostdin',
+            '-loglevel', 'quiet',
+            '-ss', str(start_time_in_seconds),
+            '-i', file_path,
+            '-t', str(SAMPLE_DURATION_IN_SECONDS),
+            '-map', '0:v:0',
+            '-map', '0:a:0',
+            '-c', 'copy',
+            source_sample_file_name
+        ])
+        source_sample_file_names.append(source_sample_file_name)
+
+    cuts = list(executor.map(functools.partial(subprocess.run, close_fds=False), commands))
+    for source_sample_file_name, cut in zip(source_sample_file_names, cuts):
+        if cut.returncode != 0:
+            raise IOError(f'sample cut failed: {source_sample_file_name}')
+    return source_sample_file_names
+
+
+def predict_bit_rate(sample_encoder, cq, source_sample_file_names, sample_directory, executor):
+    logger.info(f'Trying CQ {cq}...')
+    encoders = []
+    sample_file_names = []
+    for sample_index, source_sample_file_name in enumerate(source_sample_file_names, start=1):
+        sample_file_name = os.path.join(sample_directory, f'cq_{cq}_sample_{sample_index}.mkv')
+        # setters replace their command lists, so a shallow copy never touches the template
+        encoder = copy.copy(sample_encoder)
+        encoder.input(source_sample_file_name)
+        encoder.output(sample_file_name)
+        encoder.quality(cq)
+        encoders.append(encoder)
+        sample_file_names.append(sample_file_name)
+
+    list(executor.map(functools.partial(Handbrake.run, quiet_run=True), encoders))
+
+    bit_rate_sum = 0
+    for sample_file_name in sample_file_names:
+        sample_bit_rate = sample_bit_rate_kbps(sample_file_name, SAMPLE_DURATION_IN_SECONDS)
+        bit_rate_sum += sample_bit_rate
+        os.unlink(sample_file_name)
+
+    bit_rate_mean = bit_rate_sum / len(sample_file_names)
+    logger.info(f'Predicted bit rate for CQ {cq} is {bit_rate_mean}')
+    return bit_rate_mean
+
+
+def solve_quality_option(cq_1, bit_rate_1, cq_2, bit_rate_2, target_bit_rate, low_cq, high_cq):
+    # bit rate grows roughly exponentially with cq, so fit log(bit rate) = a + b * cq
+    # through both points and solve it for the target
+    if cq_1 == cq_2 or bit_rate_1 == bit_rate_2:
+        return cq_1
+    slope = (math.log(bit_rate_2) - math.log(bit_rate_1)) / (cq_2 - cq_1)
+    intercept = math.log(bit_rate_1) - slope * cq_1
+    cq = round((math.log(target_bit_rate) - intercept) / slope)
+    return min(max(cq, low_cq), high_cq)
+
+
+def find_quality_option(media_info, target_bit_rate, concurrency, prior_cq=None):
     logger.info(f'Finding optimal cq value for {os.path.basename(media_info.file_path)}')
     temporary_directory = tempfile.TemporaryDirectory()
     duration = media_info.duration_in_seconds
-    steps = 5
+    # windows at 1/4, 1/2 and 3/4 of the runtime stay clear of intros and credits
+    steps = 3
+    start_times = [duration * sample_index / (steps + 1) for sample_index in range(1, steps + 1)]
     low_cq = 20
     high_cq = 80
     if media_info.height <= 1080:
         low_cq = 25
         high_cq = 75
-    
-    while low_cq <= high_cq:
-        cq = int((low_cq + high_cq) / 2)
-        bit_rate_sum = 0
-        logger.info(f'Trying CQ {cq}...')
-        for sample_index in range(1, steps):
-            sample_file_name = f'{temporary_directory.name}/cq_{cq}_sample_{sample_index}.mkv'
-            start_time_in_seconds = duration * sample_index / (steps + 1)
-            encoder = Handbrake()
-            encoder.input(media_info.file_path)
-            encoder.output(sample_file_name)
-            if media_info.audios[0].channels <= 2:
-                encoder.audio_encoder('aac')
-            else:
-                encoder.audio_encoder('ac3')
-            encoder.start_time(start_time_in_seconds)
-            encoder.stop_at(20)
-            encoder.quality(cq)
-            encoder.run(quiet_run=True)
-
-            sample_media_info = FFProbe(sample_file_name)
-            sample_bit_rate = sample_media_info.bitrate / 1000 + 2000
-            bit_rate_sum += sample_bit_rate
-        
-        bit_rate_mean = bit_rate_sum / steps
-        logger.info(f'Predicted bit rate for CQ {cq} is {bit_rate_mean}')
-        if bit_rate_mean > target_bit_rate + 900:
-            high_cq = cq - 1
-        elif bit_rate_mean < target_bit_rate:
-            low_cq = cq + 1
-        else:
+    low_bit_rate = target_bit_rate
+    high_bit_rate = target_bit_rate + 1125
+    model_bit_rate = (low_bit_rate + high_bit_rate) / 2
+
+    # only the input, output and quality change between sample encodes.
+    # a stream copy cut starts at the keyframe before the window, so stop each
+    # encode at the sample length to keep the bit rate over a known duration
+    sample_encoder = Handbrake()
+    sample_encoder.stop_at(SAMPLE_DURATION_IN_SECONDS)
+    if media_info.audios[0].channels <= 2:
+        sample_encoder.audio_encoder('aac')
+    else:
+        sample_encoder.audio_encoder('ac3')
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    source_sample_file_names = cut_samples(media_info.file_path, start_times, temporary_directory.name, executor)
+    # consecutive titles from the same source tend to land near the same cq, so try
+    # around the last one first and only fall back to the full range if that misses
+    search_ranges = [(low_cq, high_cq)]
+    if prior_cq is not None:
+        search_ranges.insert(0, (max(low_cq, prior_cq - 5), min(high_cq, prior_cq + 5)))
+
+    # cq -> measured bit rate
+    bit_rates = {}
+    for range_low_cq, range_high_cq in search_ranges:
+        if len(bit_rates) < 2:
+            for cq in (range_low_cq, range_high_cq):
+                bit_rates[cq] = predict_bit_rate(sample_encoder, cq, source_sample_file_names, temporary_directory.name, executor)
+
+        while True:
+            # fit through the two tries that landed closest to the target
+            cq_1, cq_2 = sorted(bit_rates, key=lambda tried_cq: abs(math.log(bit_rates[tried_cq] / model_bit_rate)))[:2]
+            cq = solve_quality_option(cq_1, bit_rates[cq_1], cq_2, bit_rates[cq_2],
+                                      model_bit_rate, range_low_cq, range_high_cq)
+            if cq in bit_rates:
+                break
+            bit_rates[cq] = predict_bit_rate(sample_encoder, cq, source_sample_file_names, temporary_directory.name, executor)
+            if low_bit_rate <= bit_rates[cq] <= high_bit_rate:
+                break
+
+        if low_bit_rate <= bit_rates[cq] <= high_bit_rate:
             break
+    bit_rate_mean = bit_rates[cq]
 
+    executor.shutdown()
     logger.info(f'Using CQ {cq} for a predicted bit rate of {bit_rate_mean}')
     temporary_directory.cleanup()
     return cq
 
 
-def find_burn_subtitle_track(subtitles):
-    for subtitle in subtitles:
-        if subtitle.forced:
-            return subtitle.index
-        elif media_info.audios[0].language != 'eng' and subtitle.language == 'eng':
-            return subtitle.index
+def file_fingerprint(file_path):
+    # hashing a whole rip would take longer than some searches, so use the size plus its ends
+    size = os.path.getsize(file_path)
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as media_file:
+        file_hash.update(media_file.read(FINGERPRINT_CHUNK_SIZE))
+        media_file.seek(max(0, size - FINGERPRINT_CHUNK_SIZE))
+        file_hash.update(media_file.read(FINGERPRINT_CHUNK_SIZE))
+    file_hash.update(size.to_bytes(8, 'little'))
+    return file_hash.hexdigest()
+
+
+def find_burn_subtitle_track(media_info):
+    try:
+        return media_info.subtitle_indexes[media_info.subtitle_forced.index(True)]
+    except ValueError:
+        pass
+    if media_info.audios[0].language != 'eng':
+        try:
+            return media_info.subtitle_indexes[media_info.subtitle_languages.index('eng')]
+        except ValueError:
+            pass
     return 0
 
 
-def inject_dolby_vision(raw_file_path, encoded_file_path, frames_per_second):
-    temporary_directory = tempfile.TemporaryDirectory()
-    rpu_directory = f'{temporary_directory.name}/RPU.bin'
-    encoded_file_stream_directory = f'{temporary_directory.name}/com.hevc'
-    injected_file_stream_directory = f'{temporary_directory.name}/inj.hevc'
+def enlarge_pipe(pipe_file_descriptor):
+    # the default pipe buffer is only 64 KiB on linux, far too small for a full hevc stream
+    if hasattr(fcntl, 'F_SETPIPE_SZ'):
+        try:
+            fcntl.fcntl(pipe_file_descriptor, fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+        except OSError:
+            pass
+
 
+def extract_dolby_vision_metadata(raw_file_path, rpu_file_path):
     logger.info('Extracting dolby vision metadata')
-    ffpmeg = subprocess.Popen([
-        'ffmpeg',
+    pipe_read, pipe_write = os.pipe()
+    enlarge_pipe(pipe_write)
+    ffmpeg = subprocess.Popen([
+        tool_path('ffmpeg'),
+        '-nostdin',
         '-loglevel', 'quiet',
         '-i', raw_file_path,
         '-c:v', 'copy',
         '-vbsf', 'hevc_mp4toannexb',
         '-f', 'hevc',
         '-'
-    ], stdout=subprocess.PIPE)
+    ], stdout=pipe_write, close_fds=False)
 
-    subprocess.run([
-        'dovi_tool',
+    # runs in the background during the encode, so keep its progress output off the terminal
+    dovi_tool = subprocess.Popen([
+        tool_path('dovi_tool'),
         '-m', '2',
         '--crop',
         'extract-rpu',
         '-',
-        '-o', rpu_directory
-    ], stdin=ffpmeg.stdout)
+        '-o', rpu_file_path
+    ], stdin=pipe_read, stdout=devnull, close_fds=False)
+    os.close(pipe_read)
+    os.close(pipe_write)
+    return [ffmpeg, dovi_tool]
+
 
+def inject_dolby_vision(rpu_file_path, encoded_file_path, frames_per_second):
+    temporary_directory = tempfile.TemporaryDirectory()
+    encoded_file_stream_directory = os.path.join(temporary_directory.name, 'com.hevc')
+    injected_file_stream_directory = os.path.join(temporary_directory.name, 'inj.hevc')
+    remuxed_file_path = os.path.join(temporary_directory.name, 'remux.mkv')
+
+    # inject-rpu reopens its input to interleave the rpus, so it needs a raw hevc file, not a pipe
     logger.info('extracting encoded video stream')
-    subprocess.run([
-        'mkvextract',
-        encoded_file_path,
-        'tracks', f'0:{encoded_file_stream_directory}'
-    ])
+    ffmpeg = subprocess.run([
+        tool_path('ffmpeg'),
+        '-nostdin',
+        '-loglevel', 'quiet',
+        '-i', encoded_file_path,
+        '-c:v', 'copy',
+        '-bsf:v', 'hevc_mp4toannexb',
+        '-f', 'hevc',
+        encoded_file_stream_directory
+    ], close_fds=False)
+    if ffmpeg.returncode != 0:
+        raise IOError(f'could not extract encoded video stream: {encoded_file_path}')
+
     logger.info('injecting dolby vision metadata into encoded stream')
-    subprocess.run([
-        'dovi_tool',
+    dovi_tool = subprocess.run([
+        tool_path('dovi_tool'),
         'inject-rpu',
         '-i', encoded_file_stream_directory,
-        '--rpu-in', rpu_directory,
+        '--rpu-in', rpu_file_path,
         '-o', injected_file_stream_directory
-    ])
-
-    old_encoded_file = f'{encoded_file_path}.old'
-    os.rename(encoded_file_path, old_encoded_file)
+    ], close_fds=False)
+    if dovi_tool.returncode != 0:
+        raise IOError(f'dolby vision injection failed: {encoded_file_path}')
 
     logger.info('remuxing video file with dolby vision')
-    subprocess.run([
-        'mkvmerge',
+    mkvmerge = subprocess.run([
+        tool_path('mkvmerge'),
         '--default-duration', f'0:{frames_per_second}fps',
         injected_file_stream_directory,
-        '-D', old_encoded_file,
-        '-o', encoded_file_path
-    ])
-
-    os.remove(old_encoded_file)
+        '-D', encoded_file_path,
+        '-o', remuxed_file_path
+    ], close_fds=False)
+    # mkvmerge exits with 1 for warnings, only 2 means the output is unusable
+    if mkvmerge.returncode > 1:
+        raise IOError(f'dolby vision remux failed: {encoded_file_path}')
+
+    # the encode is only replaced once every step has succeeded
+    shutil.move(remuxed_file_path, encoded_file_path)
     temporary_directory.cleanup()
 
 
-def inject_hdr(raw_file_path, encoded_file_path):
+def fraction_to_float(value):
+    numerator, _, denominator = value.partition('/')
+    if denominator:
+        return float(numerator) / float(denominator)
+    return float(value)
+
+
+def read_hdr_metadata(raw_file_path):
     logger.info('extracting hdr metadata')
     ffprobe_hdr = subprocess.run([
-        'ffprobe',
+        tool_path('ffprobe'),
         '-loglevel', 'quiet',
         '-select_streams', 'v:0',
         '-show_frames',
         '-read_intervals', '%+#1',
         '-show_entries', 'frame=side_data_list',
-        '-print_format', 'json',
+        '-print_format', 'default=noprint_wrappers=1',
         raw_file_path
-    ], capture_output=True, text=True)
-
-    hdr_info = json.loads(ffprobe_hdr.stdout)
-
-    md = ''
-    cll = ''
-
-    for frame in hdr_info['frames']:
-        for side_data in frame['side_data_list']:
-            if side_data['side_data_type'] == 'Content light level metadata':
-                cll = side_data
-            elif side_data['side_data_type'] == 'Mastering display metadata':
-                md = side_data
-
-    if cll == '' or md == '':
+    ], capture_output=True, text=True, close_fds=False)
+
+    # each side data entry starts with its side_data_type line. dolby vision frames carry
+    # rpu side data too, so only keep the fields of the two hdr entries
+    hdr_metadata = {}
+    side_data_type = None
+    for line in ffprobe_hdr.stdout.splitlines():
+        key, _, value = line.partition('=')
+        if key == 'side_data_type':
+            side_data_type = value
+        elif side_data_type in ('Mastering display metadata', 'Content light level metadata'):
+            hdr_metadata[key] = value
+
+    if 'max_content' not in hdr_metadata or 'red_x' not in hdr_metadata:
+        return None
+    return hdr_metadata
+
+
+def inject_hdr(hdr_metadata, encoded_file_path):
+    if hdr_metadata is None:
         return
-    
-    max_content = cll['max_content']
-    max_average = cll['max_average']
-
-    red_x = float(Fraction(md['red_x']))
-    red_y = float(Fraction(md['red_y']))
-    green_x = float(Fraction(md['green_x']))
-    green_y = float(Fraction(md['green_y']))
-    blue_x = float(Fraction(md['blue_x']))
-    blue_y = float(Fraction(md['blue_y']))
-    white_x = float(Fraction(md['white_point_x']))
-    white_y = float(Fraction(md['white_point_y']))
-    max_luminance = float(Fraction(md['max_luminance']))
-    min_luminance = float(Fraction(md['min_luminance']))
 
+    max_content = hdr_metadata['max_content']
+    max_average = hdr_metadata['max_average']
+
+    red_x = fraction_to_float(hdr_metadata['red_x'])
+    red_y = fraction_to_float(hdr_metadata['red_y'])
+    green_x = fraction_to_float(hdr_metadata['green_x'])
+    green_y = fraction_to_float(hdr_metadata['green_y'])
+    blue_x = fraction_to_float(hdr_metadata['blue_x'])
+    blue_y = fraction_to_float(hdr_metadata['blue_y'])
+    white_x = fraction_to_float(hdr_metadata['white_point_x'])
+    white_y = fraction_to_float(hdr_metadata['white_point_y'])
+    max_luminance = fraction_to_float(hdr_metadata['max_luminance'])
+    min_luminance = fraction_to_float(hdr_metadata['min_luminance'])
+
+    # fixed point keeps python from ever handing mkvpropedit exponent notation such as 5e-05
     logger.info('injecting hdr metadata into encode stream')
     subprocess.run([
-        'mkvpropedit',
+        tool_path('mkvpropedit'),
         encoded_file_path,
         '--edit', 'track:v1',
         '--set', f'max-content-light={max_content}',
         '--set', f'max-frame-light={max_average}',
-        '--set', f'chromaticity-coordinates-red-x={red_x}',
-        '--set', f'chromaticity-coordinates-red-y={red_y}',
-        '--set', f'chromaticity-coordinates-green-x={green_x}',
-        '--set', f'chromaticity-coordinates-green-y={green_y}',
-        '--set', f'chromaticity-coordinates-blue-x={blue_x}',
-        '--set', f'chromaticity-coordinates-blue-y={blue_y}',
-        '--set', f'white-coordinates-x={white_x}',
-        '--set', f'white-coordinates-y={white_y}',
-        '--set', f'max-luminance={max_luminance}',
-        '--set', f'min-luminance={min_luminance}'
-    ])
+        '--set', f'chromaticity-coordinates-red-x={red_x:.6f}',
+        '--set', f'chromaticity-coordinates-red-y={red_y:.6f}',
+        '--set', f'chromaticity-coordinates-green-x={green_x:.6f}',
+        '--set', f'chromaticity-coordinates-green-y={green_y:.6f}',
+        '--set', f'chromaticity-coordinates-blue-x={blue_x:.6f}',
+        '--set', f'chromaticity-coordinates-blue-y={blue_y:.6f}',
+        '--set', f'white-coordinates-x={white_x:.6f}',
+        '--set', f'white-coordinates-y={white_y:.6f}',
+        '--set', f'max-luminance={max_luminance:.6f}',
+        '--set', f'min-luminance={min_luminance:.6f}'
+    ], close_fds=False)
 
 if __name__ == '__main__':
     arguments = parse_arguments()
@@ -475,18 +646,13 @@ if __name__ == '__main__':
     file_handler = logging.FileHandler(logging_name)
     logger.addHandler(file_handler)
 
-    verify_ffprobe()
-    verify_handbrakecli()
-    verify_ffmpeg()
-    verify_dovi_tool()
-    verify_mkvmerge()
-    verify_mkvextract()
-    verify_mkvpropedit()
+    verify_tools()
 
     media_info = FFProbe(arguments.file_name)
     target_bit_rate = arguments.target
     quality_option = arguments.quality
     should_crop = arguments.crop
+    concurrency = arguments.concurrency
     burn_subtitle_track = arguments.burn_subtitle
 
     if os.path.isfile(output_path):
@@ -494,40 +660,94 @@ if __name__ == '__main__':
 
     if target_bit_rate == 0:
         if media_info.height > 1080:
-            target_bit_rate = 12000
+            target_bit_rate = 13000
         else:
-            target_bit_rate = 4000
-
-    if quality_option is None:
-        quality_option = find_quality_option(media_info, target_bit_rate)
-
-    encoder = Handbrake()
-    encoder.input(media_info.file_path)
-    encoder.output(output_path)
-    encoder.quality(quality_option)
+            target_bit_rate = 3000
 
-    if media_info.audios[0].channels <= 2:
-        encoder.audio_encoder('aac')
-    else:
-        encoder.audio_encoder('ac3')
+    if concurrency == 0:
+        concurrency = default_concurrency()
 
-    if should_crop:
-        encoder.previews(60)
-        encoder.crop()
+    # both only read the source, so pull its metadata while the cq search and encode run
+    rpu_extraction = []
+    if media_info.is_dolby_vision:
+        dolby_vision_directory = tempfile.TemporaryDirectory()
+        rpu_file_path = os.path.join(dolby_vision_directory.name, 'RPU.bin')
+        rpu_extraction = extract_dolby_vision_metadata(media_info.file_path, rpu_file_path)
+        hdr_probe = ThreadPoolExecutor(max_workers=1)
+        hdr_metadata = hdr_probe.submit(read_hdr_metadata, media_info.file_path)
 
-    subtitle_track = 0
-    if burn_subtitle_track.isdigit():
-        subtitle_track = int(burn_subtitle_track)
-    elif burn_subtitle_track == 'auto' and media_info.is_dolby_vision == False:
-        subtitle_track = find_burn_subtitle_track(media_info.subtitles)
-    if subtitle_track != 0:
-        encoder.burn_subtitle(subtitle_track)
+    try:
+        if quality_option is None:
+            # re-runs on the same file, e.g. to change subtitles or crop, reuse the cq found last time
+            cq_cache = load_json_cache(CQ_CACHE_PATH)
+            cached_files = cq_cache.setdefault('files', {})
+            cached_resolutions = cq_cache.setdefault('resolutions', {})
+            cq_cache_key = f'{file_fingerprint(media_info.file_path)}:{target_bit_rate}:{media_info.height}'
+            resolution_key = f'{"2160p" if media_info.height > 1080 else "1080p"}:{target_bit_rate}'
+            quality_option = cached_files.get(cq_cache_key)
+            if quality_option is None:
+                quality_option = find_quality_option(media_info, target_bit_rate, concurrency,
+                                                     cached_resolutions.get(resolution_key))
+                cached_files[cq_cache_key] = quality_option
+                cached_resolutions[resolution_key] = quality_option
+                save_json_cache(CQ_CACHE_PATH, cq_cache)
+            else:
+                logger.info(f'Using cached CQ {quality_option} for {os.path.basename(media_info.file_path)}')
 
-    encoder.run()
+        # encode on the local scratch disk so writes don't compete with reading the source,
+        # and only move the file into place once it's complete
+        scratch_directory = tempfile.TemporaryDirectory()
+        scratch_path = os.path.join(scratch_directory.name, output_path)
 
-    output_media_info = FFProbe(output_path)
-    if media_info.is_dolby_vision:
-        inject_dolby_vision(media_info.file_path, output_path, media_info.frame_rate)
-        inject_hdr(media_info.file_path, output_path)
+        encoder = Handbrake()
+        encoder.input(media_info.file_path)
+        encoder.output(scratch_path)
+        encoder.quality(quality_option)
 
-    logger.info(f'Actual bitrate for file {output_path}: {output_media_info.bitrate}')
\ No newline at end of file
+        if media_info.audios[0].channels <= 2:
+            encoder.audio_encoder('aac')
+        else:
+            encoder.audio_encoder('ac3')
+
+        if should_crop:
+            encoder.previews(60)
+            encoder.crop()
+
+        subtitle_track = 0
+        if burn_subtitle_track.isdigit():
+            subtitle_track = int(burn_subtitle_track)
+        elif burn_subtitle_track == 'auto' and media_info.is_dolby_vision == False:
+            subtitle_track = find_burn_subtitle_track(media_info)
+        if subtitle_track != 0:
+            encoder.burn_subtitle(subtitle_track)
+
+        encoder.run()
+        if os.path.isfile(scratch_path) == False:
+            raise IOError(f'encode failed: {output_path}')
+
+        if media_info.is_dolby_vision:
+            try:
+                if any([process.wait() != 0 for process in rpu_extraction]):
+                    raise IOError(f'dolby vision metadata extraction failed: {media_info.file_path}')
+                inject_dolby_vision(rpu_file_path, scratch_path, media_info.frame_rate)
+            except IOError:
+                # don't let the scratch directory take the encode with it
+                shutil.move(scratch_path, output_path)
+                logger.error(f'Kept {output_path} without dolby vision metadata')
+                raise
+            inject_hdr(hdr_metadata.result(), scratch_path)
+            hdr_probe.shutdown()
+            dolby_vision_directory.cleanup()
+    finally:
+        # a failed search or encode must not leave ffmpeg and dovi_tool running
+        for process in rpu_extraction:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    shutil.move(scratch_path, output_path)
+    scratch_directory.cleanup()
+
+    # same figure ffprobe reports as the container bit rate
+    output_bit_rate = os.path.getsize(output_path) * 8 / media_info.duration_in_seconds
+    logger.info(f'Actual bitrate for file {output_path}: {output_bit_rate}')
\ No newline at end of file